@@ -1,14 +1,24 @@
 import os
+import re
 from flask import Flask, render_template, request, jsonify, session
 import google.generativeai as genai
-from googlemaps import Client as GoogleMaps
+import httpx
 from dotenv import load_dotenv
 import urllib.parse
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import sqlite3
 from datetime import datetime
 import logging
 from logging.handlers import RotatingFileHandler
 import uuid
+import functools
+import threading
+from collections import OrderedDict
+from cachetools import TTLCache
 
 
 # Load environment variables
@@ -21,10 +31,36 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', '3d6f45a5fc12445dbac2f59c3b6c7cb1')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///navia.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_RECORD_QUERIES'] = False
+
+# In-memory SQLite uses a single static connection, so only size real pools;
+# liveness checks only matter for networked databases
+database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+if database_url.get_backend_name() != 'sqlite':
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800
+    }
+elif database_url.database not in (None, '', ':memory:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 20,
+        'max_overflow': 10
+    }
 
 # Initialize SQLAlchemy
 db = SQLAlchemy(app)
 
+# WAL lets readers proceed during the per-turn history write and avoids an fsync per commit
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 # Set API Keys
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
@@ -33,7 +69,14 @@ if not GOOGLE_API_KEY or not GEMINI_API_KEY:
     raise ValueError("API keys not set. Please check your environment variables.")
 
 # Initialize Gemini & Maps
-gmaps = GoogleMaps(key=GOOGLE_API_KEY)
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+STATIC_MAP_URL = "https://maps.googleapis.com/maps/api/staticmap"
+WAZE_URL = "https://www.waze.com/ul"
+maps_client = httpx.Client(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20)
+)
 genai.configure(api_key=GEMINI_API_KEY)
 
 # Database models
@@ -42,6 +85,8 @@ class User(db.Model):
     session_id = db.Column(db.String(100), unique=True, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    chat_history = db.relationship('ChatHistory', back_populates='user', lazy='select')
+
 class ChatHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -49,34 +94,77 @@ class ChatHistory(db.Model):
     role = db.Column(db.String(10), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
-    user = db.relationship('User', backref=db.backref('chat_history', lazy=True))
+    user = db.relationship('User', back_populates='chat_history', lazy='select')
+
+    __table_args__ = (
+        db.Index('ix_chat_user_ts', user_id, timestamp.desc()),
+    )
 
 # Set up logging
 if not app.debug:
-    file_handler = RotatingFileHandler('navia.log', maxBytes=10240, backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-    ))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+    # app.logger outlives re-imports of this module; drop a previously attached file handler
+    for handler in [h for h in app.logger.handlers if isinstance(h, RotatingFileHandler)]:
+        app.logger.removeHandler(handler)
+        handler.close()
+    # Size-based rotation isn't safe across processes, so multi-worker servers
+    # (see wsgi.py) set NAVIA_LOG_STDERR and leave the log to Flask's stderr handler
+    if not os.environ.get('NAVIA_LOG_STDERR'):
+        file_handler = RotatingFileHandler('navia.log', maxBytes=10240, backupCount=10)
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+        ))
+        file_handler.setLevel(logging.INFO)
+        app.logger.addHandler(file_handler)
     app.logger.setLevel(logging.INFO)
+    app.logger.propagate = False
     app.logger.info('Navia startup')
 
+def fetch_directions(origin: str, destination: str, mode: str) -> list:
+    response = maps_client.get(DIRECTIONS_URL, params={
+        "origin": origin,
+        "destination": destination,
+        "mode": mode,
+        "key": GOOGLE_API_KEY
+    })
+    # Don't raise_for_status(): its message embeds the request URL, API key included
+    if response.status_code != 200:
+        raise RuntimeError(f"Directions API returned HTTP {response.status_code}")
+    data = response.json()
+    if data['status'] == 'ZERO_RESULTS':
+        return []
+    if data['status'] != 'OK':
+        raise RuntimeError(f"Directions API error: {data['status']} {data.get('error_message', '')}".strip())
+    return data['routes']
+
+# Directions API results, keyed by normalized (origin, destination, mode)
+directions_cache = TTLCache(maxsize=512, ttl=900)
+directions_cache_lock = threading.Lock()
+
 # Define direction parameters & instructions
 def get_detailed_directions(origin: str, destination: str) -> dict:
     try:
-        directions = gmaps.directions(origin, destination, mode="driving")
+        cache_key = (origin.strip().lower(), destination.strip().lower(), "driving")
+        with directions_cache_lock:
+            directions = directions_cache.get(cache_key)
+        if directions is None:
+            directions = fetch_directions(origin, destination, "driving")
+            with directions_cache_lock:
+                directions_cache[cache_key] = directions
         app.logger.info('Fetching directions...')
 
         if directions:
             route = directions[0]
             leg = route['legs'][0]
 
-            map_url = f"https://maps.googleapis.com/maps/api/staticmap?size=600x300&maptype=roadmap"
-            map_url += f"&markers=color:green|label:A|{origin}"
-            map_url += f"&markers=color:red|label:B|{destination}"
-            map_url += f"&path=enc:{route['overview_polyline']['points']}"
-            map_url += f"&key={GOOGLE_API_KEY}"
+            map_params = {
+                "size": "600x300",
+                "maptype": "roadmap",
+                "markers": [f"color:green|label:A|{origin}", f"color:red|label:B|{destination}"],
+                "path": f"enc:{route['overview_polyline']['points']}",
+                "key": GOOGLE_API_KEY
+            }
+            map_url = f"{STATIC_MAP_URL}?{urllib.parse.urlencode(map_params, doseq=True)}"
+            # Never log map_url itself, it carries the API key
             app.logger.info('Map URL generated')
 
             steps = [
@@ -92,7 +180,7 @@ def get_detailed_directions(origin: str, destination: str) -> dict:
             
             origin_coords = f"{leg['start_location']['lat']},{leg['start_location']['lng']}"
             dest_coords = f"{leg['end_location']['lat']},{leg['end_location']['lng']}"
-            waze_url = f"https://www.waze.com/ul?navigate=yes&from={urllib.parse.quote(origin_coords)}&to={urllib.parse.quote(dest_coords)}"
+            waze_url = f"{WAZE_URL}?{urllib.parse.urlencode({'navigate': 'yes', 'from': origin_coords, 'to': dest_coords})}"
             
             return {
                 "origin": leg['start_address'],
@@ -109,9 +197,30 @@ def get_detailed_directions(origin: str, destination: str) -> dict:
         else:
             return {"error": "No route found"}
     except Exception as e:
-        app.logger.error(f'Error in get_detailed_directions: {str(e)}')
+        app.logger.error('Error in get_detailed_directions: %s', e)
         return {"error": str(e)}
 
+def directions_message(directions_info: dict) -> str:
+    if "error" in directions_info:
+        return f"I'm sorry, but I couldn't retrieve directions: {directions_info['error']}"
+    directions_summary = f"Here are the directions from {directions_info['origin']} to {directions_info['destination']}:\n"
+    directions_summary += f"Distance: {directions_info['distance']}\n"
+    directions_summary += f"Duration: {directions_info['duration']}\n"
+    directions_summary += "Steps:\n"
+    for i, step in enumerate(directions_info['steps'], 1):
+        directions_summary += f"{i}. {step['instruction']} ({step['distance']} - {step['duration']})\n"
+    return directions_summary
+
+# Messages that are nothing but a route request ("directions from X to Y"),
+# answered without a function call. Places can't contain punctuation or a
+# trailing clause (by bike, avoiding tolls, please...); anything richer goes
+# through Gemini's function calling, which extracts clean arguments.
+DIRECTIONS_PLACE = r"((?:(?!\s(?:to|from|by|via|avoid|avoiding|without|using|please|thanks|and|then)\b)[^,;:?.!])+)"
+DIRECTIONS_PATTERN = re.compile(
+    rf"(?:directions|route|how (?:do i|to) get) from {DIRECTIONS_PLACE} to {DIRECTIONS_PLACE}\s*[?.!]?",
+    re.IGNORECASE
+)
+
 # Set the Model & Function calling structure directions parameters
 model = genai.GenerativeModel(
     model_name='gemini-1.5-flash-latest',
@@ -135,65 +244,183 @@ model = genai.GenerativeModel(
     ]
 )
 
+@app.before_request
+def ensure_session_id():
+    if 'user_id' not in session:
+        session['user_id'] = str(uuid.uuid4())
+
 @app.route('/about')
 def about():
     return render_template('about.html')
 
 @app.route('/')
 def home():
-    if 'user_id' not in session:
-        session['user_id'] = str(uuid.uuid4())
     return render_template('index.html', google_api_key=GOOGLE_API_KEY)
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    user_input = request.json['message']
-    app.logger.info('Processing user input request...')
-    
-    user = User.query.filter_by(session_id=session['user_id']).first()
+# Cache of model replies for repeated prompts in an identical conversation state
+response_cache = TTLCache(maxsize=1024, ttl=3600)
+response_cache_lock = threading.Lock()
+
+def response_cache_key(chat_history: list, user_input: str) -> tuple:
+    history = tuple((content.role, ''.join(part.text for part in content.parts)) for content in chat_history)
+    return history, ' '.join(user_input.casefold().split())
+
+# Live Gemini chat sessions by session_id (LRU), so follow-up turns skip
+# reloading history and rebuilding the chat. Each entry records the newest
+# ChatHistory.id it has seen; a session whose user has newer rows (e.g. a turn
+# served by another worker) is discarded and rebuilt from the database. A
+# session is checked out for the duration of a turn and only returned on
+# success, so concurrent or failed turns also fall back to the database.
+MAX_CHAT_SESSIONS = 1000
+MAX_CHAT_HISTORY = 10
+chat_sessions = OrderedDict()
+chat_sessions_lock = threading.Lock()
+
+def checkout_chat_session(session_id: str, user_id: int):
+    with chat_sessions_lock:
+        entry = chat_sessions.pop(session_id, None)
+    if entry is None:
+        return None
+    chat, last_history_id = entry
+    if last_history_id != latest_chat_history_id(user_id):
+        return None
+    return chat
+
+def checkin_chat_session(session_id: str, chat, history: list, last_history_id: int) -> None:
+    # Keep the same shape the database rebuild produces: user input and final
+    # reply only, without function calls or directions summaries
+    chat.history = history[-MAX_CHAT_HISTORY:]
+    with chat_sessions_lock:
+        chat_sessions[session_id] = (chat, last_history_id)
+        chat_sessions.move_to_end(session_id)
+        while len(chat_sessions) > MAX_CHAT_SESSIONS:
+            chat_sessions.popitem(last=False)
+
+# Database helpers
+# Dialects supporting INSERT ... ON CONFLICT DO NOTHING RETURNING
+UPSERT_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+# session_id -> user.id never changes, so cache the id (not the ORM instance)
+@functools.lru_cache(maxsize=10000)
+def get_or_create_user(session_id: str) -> int:
+    # insert_returning is False on SQLite older than 3.35
+    insert = UPSERT_INSERTS.get(db.engine.dialect.name)
+    if insert is not None and db.engine.dialect.insert_returning:
+        user_id = db.session.execute(
+            insert(User)
+            .values(session_id=session_id)
+            .on_conflict_do_nothing(index_elements=['session_id'])
+            .returning(User.id)
+        ).scalar()
+        db.session.commit()
+        if user_id is not None:
+            return user_id
+
+    user = User.query.filter_by(session_id=session_id).first()
     if not user:
-        user = User(session_id=session['user_id'])
+        user = User(session_id=session_id)
         db.session.add(user)
         db.session.commit()
+    return user.id
+
+def load_chat_history(user_id: int) -> list:
+    chat_history = db.session.execute(
+        db.select(ChatHistory.role, ChatHistory.message)
+        .where(ChatHistory.user_id == user_id)
+        .order_by(ChatHistory.timestamp.desc())
+        .limit(MAX_CHAT_HISTORY)
+    ).all()
+    return [{"role": role, "parts": [message]} for role, message in reversed(chat_history)]
+
+def chat_turn(user_input: str, response_text: str) -> list:
+    return [{"role": "user", "parts": [user_input]}, {"role": "model", "parts": [response_text]}]
+
+def latest_chat_history_id(user_id: int):
+    return db.session.execute(
+        db.select(db.func.max(ChatHistory.id)).where(ChatHistory.user_id == user_id)
+    ).scalar()
+
+def save_chat_history(user_id: int, user_input: str, response_text: str) -> int:
+    model_turn = ChatHistory(user_id=user_id, message=response_text, role="model")
+    db.session.add_all([
+        ChatHistory(user_id=user_id, message=user_input, role="user"),
+        model_turn
+    ])
+    db.session.flush()
+    last_history_id = model_turn.id
+    db.session.commit()
+    return last_history_id
 
-    chat_history = ChatHistory.query.filter_by(user_id=user.id).order_by(ChatHistory.timestamp.desc()).limit(10).all()
-    chat_history = [{"role": ch.role, "parts": [ch.message]} for ch in reversed(chat_history)]
+@app.route('/chat', methods=['POST'])
+def chat():
+    user_input = request.json['message']
+    session_id = session['user_id']
+    app.logger.info('Processing user input request...')
     
-    chat = model.start_chat(enable_automatic_function_calling=True, history=chat_history)
+    user_id = get_or_create_user(session_id)
+    chat = checkout_chat_session(session_id, user_id)
+    if chat is None:
+        chat_history = load_chat_history(user_id)
+        chat = model.start_chat(enable_automatic_function_calling=True, history=chat_history)
+    history = list(chat.history)
     
-    response = chat.send_message(user_input)
+    cache_key = response_cache_key(history, user_input)
+    with response_cache_lock:
+        cached_text = response_cache.get(cache_key)
+    if cached_text is not None:
+        app.logger.info('Serving cached response')
+        last_history_id = save_chat_history(user_id, user_input, cached_text)
+        checkin_chat_session(session_id, chat, history + chat_turn(user_input, cached_text), last_history_id)
+        return jsonify({
+            "response": cached_text,
+            "directions_info": None
+        })
     
+    # Plain "directions from X to Y" requests skip the function-calling round-trip
     directions_info = None
+    match = DIRECTIONS_PATTERN.fullmatch(user_input.strip())
+    attempted_directions = bool(match)
+    if match:
+        directions_info = get_detailed_directions(match.group(1).strip(), match.group(2).strip())
+        if "error" in directions_info:
+            directions_info = None
+        else:
+            # Keep the user's own wording so details the pattern can't parse still reach the model
+            response = chat.send_message(f"{user_input}\n\n{directions_message(directions_info)}")
+    
+    if directions_info is None:
+        response = chat.send_message(user_input)
+    
+    # The tool stays declared, so either path can still come back as a function call
     for part in response.parts:
         if part.function_call and part.function_call.name == "get_detailed_directions":
+            attempted_directions = True
             args = part.function_call.args
             directions_info = get_detailed_directions(args['origin'], args['destination'])
-            if "error" not in directions_info:
-                directions_summary = f"Here are the directions from {directions_info['origin']} to {directions_info['destination']}:\n"
-                directions_summary += f"Distance: {directions_info['distance']}\n"
-                directions_summary += f"Duration: {directions_info['duration']}\n"
-                directions_summary += "Steps:\n"
-                for i, step in enumerate(directions_info['steps'], 1):
-                    directions_summary += f"{i}. {step['instruction']} ({step['distance']} - {step['duration']})\n"
-                
-                response = chat.send_message(directions_summary)
-            else:
-                response = chat.send_message(f"I'm sorry, but I couldn't retrieve directions: {directions_info['error']}")
+            response = chat.send_message(directions_message(directions_info))
             break
     
     response_text = ' '.join(part.text for part in response.parts if part.text)
     app.logger.info('Generated response')
     
+    # Directions answers depend on live route data, so only cache plain replies
+    if not attempted_directions and response_text:
+        with response_cache_lock:
+            response_cache[cache_key] = response_text
+    
     # Save chat history to database
-    db.session.add(ChatHistory(user_id=user.id, message=user_input, role="user"))
-    db.session.add(ChatHistory(user_id=user.id, message=response_text, role="model"))
-    db.session.commit()
+    last_history_id = save_chat_history(user_id, user_input, response_text)
+    checkin_chat_session(session_id, chat, history + chat_turn(user_input, response_text), last_history_id)
     
     return jsonify({
         "response": response_text,
         "directions_info": directions_info
     })
 
+@app.cli.command('init-db')
+def init_db():
+    db.create_all()
+
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
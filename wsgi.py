@@ -0,0 +1,18 @@
+# Gunicorn entrypoint. Create the schema once before starting the workers:
+#   flask --app main init-db
+#   gunicorn -k gevent -w 4 --worker-connections 1000 -b 0.0.0.0:8080 wsgi:app
+# Workers log to stderr instead of navia.log, since several processes can't
+# share a rotating log file. Let systemd/journald collect it, or add
+# --capture-output --error-logfile navia.log and rotate that file externally.
+import os
+os.environ['NAVIA_LOG_STDERR'] = '1'
+
+# Patch the stdlib before main imports flask, httpx and sqlalchemy
+from gevent import monkey
+monkey.patch_all()
+
+# The Gemini client talks gRPC, which needs its own gevent integration
+from grpc.experimental import gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+from main import app